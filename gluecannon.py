@@ -1,120 +1,294 @@
 import os
+import re
 import sys
-import yaml
+import pickle
+import hashlib
+import struct
 import logging
+import tempfile
 import subprocess
-import argparse
-from jinja2 import Environment, FileSystemLoader
+from itertools import chain
+from types import SimpleNamespace
 
 COMPOSE_FILE = "docker-compose.yml"
-ENV_FILE = ".env"
 CONFIG_FILE = "config.yml"
 HAPROXY_CONFIG_FILE = "haproxy.cfg"
+STATE_FILE = ".gluecannon.state"
+CONFIG_CACHE_SUFFIX = ".cache"
+# Cache header: source file mtime (ns) and size, both little-endian int64
+CONFIG_CACHE_HEADER = struct.Struct("<qq")
+# Highest pickle protocol every supported Python can read
+PICKLE_PROTOCOL = 4
 DEFAULT_PROXY_PORT = 8888
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')))
+# Settings shared by every VPN service; copied shallowly, so nested values must not be mutated.
+# "environment" is filled in per service and only listed here to fix its position in the output
+_SERVICE_PROTO = {
+    "cap_add": ["NET_ADMIN"],
+    "devices": ["/dev/net/tun"],
+    "environment": None,
+    "volumes": ["gluetun:/gluetun"],
+    "logging": {
+        "driver": "json-file",
+        "options": {"max-size": "10m", "max-file": "3"},
+    },
+    "restart": "always",
+    "networks": ["vpn-network"],
+}
+
+ACTIONS = ("up", "down", "list", "run", "interactive")
+USAGE = "usage: gluecannon.py {up [--force]|down|list|run CMD...|interactive}"
+# Actions that need config.yml; the rest only talk to docker compose
+CONFIG_ACTIONS = {"up", "run", "interactive"}
+
+# yaml is imported on first use so actions that don't need it start faster
+_compose_dumper = None
+
+HAPROXY_PREAMBLE = """\
+global
+    log 127.0.0.1 local0
+    maxconn 4096
+defaults
+    log global
+    mode http
+    option httplog
+    timeout connect 5000
+    timeout client 50000
+    timeout server 50000
+frontend http-in
+    bind *:{proxy_port}
+    default_backend vpn-backends
+backend vpn-backends
+    mode http
+    balance roundrobin"""
+
+def _get_compose_dumper():
+    global _compose_dumper
+    if _compose_dumper is None:
+        import yaml
+
+        # Services share the prototype's lists; emit them inline rather than as YAML anchors
+        class ComposeDumper(getattr(yaml, "CSafeDumper", yaml.SafeDumper)):
+            def ignore_aliases(self, data):
+                return True
+
+        _compose_dumper = ComposeDumper
+    return _compose_dumper
+
+def _read_config_cache(cache_path: str, st: os.stat_result):
+    try:
+        with open(cache_path, "rb") as file:
+            header = file.read(CONFIG_CACHE_HEADER.size)
+            if header != CONFIG_CACHE_HEADER.pack(st.st_mtime_ns, st.st_size):
+                return None
+            return pickle.load(file)
+    except Exception:
+        # A stale, corrupt or unreadable cache is just a miss; fall back to parsing the YAML
+        return None
+
+def _write_config_cache(cache_path: str, st: os.stat_result, config) -> None:
+    header = CONFIG_CACHE_HEADER.pack(st.st_mtime_ns, st.st_size)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)))
+    except OSError as e:
+        logging.debug(f"Could not write configuration cache {cache_path}: {e}")
+        return
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(header + pickle.dumps(config, protocol=PICKLE_PROTOCOL))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.debug(f"Could not write configuration cache {cache_path}: {e}")
+        os.unlink(tmp_path)
 
 def load_config(file_path: str = CONFIG_FILE) -> dict:
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        logging.error(f"Configuration file not found: {file_path}")
+        sys.exit(1)
+    cache_path = file_path + CONFIG_CACHE_SUFFIX
+    config = _read_config_cache(cache_path, st)
+    if config is not None:
+        return config
+    import yaml
+    # Prefer libyaml's C parser when PyYAML was built against it
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     try:
         with open(file_path, "r") as file:
-            return yaml.safe_load(file)
+            config = yaml.load(file, Loader=Loader)
     except FileNotFoundError:
         logging.error(f"Configuration file not found: {file_path}")
         sys.exit(1)
     except yaml.YAMLError as e:
         logging.error(f"Error reading configuration file: {e}")
         sys.exit(1)
+    _write_config_cache(cache_path, st, config)
+    return config
 
-def build_env_list(provider_key: str, required_env: dict, optional_env: dict) -> list:
-    provider_name = provider_key.replace('_', ' ').lower()
-    env_list = [f"VPN_SERVICE_PROVIDER={provider_name}"]
-    for key, value in required_env.items():
-        env_list.append(f"{key}={value}")
-    for key, value in optional_env.items():
-        env_list.append(f"{key}={value}")
+def build_env_list(provider_name: str, required_env: dict, optional_env: dict) -> list:
+    env_list = ["HTTPPROXY=on", f"VPN_SERVICE_PROVIDER={provider_name}"]
+    env_list.extend(f"{key}={value}" for key, value in chain(required_env.items(), optional_env.items()))
     return env_list
 
-def generate_compose_file(config: dict, file_path: str = COMPOSE_FILE):
+def _write_if_changed(file_path: str, content: bytes) -> bool:
+    # Leave identical files untouched so their mtime (and anything watching it) stays put
+    try:
+        with open(file_path, "rb") as file:
+            if file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(file_path, "wb") as file:
+        file.write(content)
+    return True
+
+def generate_all(config: dict, compose_path: str = COMPOSE_FILE, haproxy_path: str = HAPROXY_CONFIG_FILE):
     global_config = config.get("global_settings", {})
     proxy_port = global_config.get("proxy_port", DEFAULT_PROXY_PORT)
     image = global_config.get("image", "default_image")
+    service_names = []
     services = {}
     for provider_key, provider in config.get("vpn_providers", {}).items():
+        required_env = provider.get("required_env", {})
+        optional_env = provider.get("optional_env", {})
+        provider_name = provider_key.replace('_', ' ').lower()
         for i in range(provider.get("num_containers", 1)):
             service_name = f"{provider_key}_{i}"
-            required_env = provider.get("required_env", {})
-            optional_env = provider.get("optional_env", {})
+            service_names.append(service_name)
+            # Same key order as the old docker-compose.yml template
             services[service_name] = {
                 "container_name": service_name,
                 "image": image,
-                "cap_add": ["NET_ADMIN"],
-                "devices": ["/dev/net/tun"],
-                "env_file": ENV_FILE,
-                "environment": build_env_list(provider_key, required_env, optional_env),
-                "volumes": ["gluetun:/gluetun"],
-                "logging": {
-                    "driver": "json-file",
-                    "options": {"max-size": "10m", "max-file": "3"},
-                },
-                "restart": "always",
-                "networks": ["vpn-network"],
+                **_SERVICE_PROTO,
+                "environment": build_env_list(provider_name, required_env, optional_env),
             }
 
-    template = env.get_template('docker-compose.yml.j2')
-    compose_content = template.render(services=services, proxy_port=proxy_port, haproxy_config_file=HAPROXY_CONFIG_FILE)
-    with open(file_path, "w") as file:
-        file.write(compose_content)
-    logging.info(f"Generated {file_path} with {len(services)} services")
-
-def generate_haproxy_config(config: dict, file_path: str = HAPROXY_CONFIG_FILE):
-    all_services = {
-        provider_key: {
-            f"{provider_key}_{i}": f"{provider_key}_{i}:8888"
-            for i in range(provider["num_containers"])
-        }
-        for provider_key, provider in config.get("vpn_providers", {}).items()
+    generate_compose_file(services, proxy_port, compose_path)
+    generate_haproxy_config(service_names, proxy_port, haproxy_path)
+
+def generate_compose_file(services: dict, proxy_port: int, file_path: str = COMPOSE_FILE):
+    import yaml
+    compose_doc = {
+        "version": "3.8",
+        "services": {
+            **services,
+            "haproxy": {
+                "container_name": "haproxy-container",
+                "image": "haproxy:2.0",
+                "ports": [f"{proxy_port}:{proxy_port}/tcp"],
+                "depends_on": list(services),
+                "restart": "always",
+                "volumes": [f"./{HAPROXY_CONFIG_FILE}:/usr/local/etc/haproxy/haproxy.cfg"],
+                "networks": ["vpn-network"],
+            },
+        },
+        "volumes": {"gluetun": None},
+        "networks": {"vpn-network": None},
     }
-    global_config = config.get("global_settings", {})
-    proxy_port = global_config.get("proxy_port", DEFAULT_PROXY_PORT)
-    template = env.get_template('haproxy.cfg.j2')
-    haproxy_config = template.render(proxy_port=proxy_port, all_services=all_services)
-    with open(file_path, "w") as file:
-        file.write(haproxy_config)
-    logging.info(f"Generated {file_path}")
+    content = yaml.dump(compose_doc, Dumper=_get_compose_dumper(), sort_keys=False, default_flow_style=False)
+    if _write_if_changed(file_path, content.encode()):
+        logging.info(f"Generated {file_path} with {len(services)} services")
+    else:
+        logging.info(f"{file_path} unchanged")
 
-def run_docker_compose_command(command: list):
+def generate_haproxy_config(service_names: list, proxy_port: int, file_path: str = HAPROXY_CONFIG_FILE):
+    lines = [HAPROXY_PREAMBLE.format(proxy_port=proxy_port)]
+    lines.extend(f"    server {name} {name}:8888 check" for name in service_names)
+    lines.append("")
+    if _write_if_changed(file_path, "\n".join(lines).encode()):
+        logging.info(f"Generated {file_path}")
+    else:
+        logging.info(f"{file_path} unchanged")
+
+def run_docker_compose_command(command: list, capture: bool = False):
+    # Only capture output when the caller needs it; otherwise docker writes straight to the terminal.
+    # Python opens its fds non-inheritable, so close_fds=False is safe and skips scanning the whole fd table
     try:
         result = subprocess.run(
             ["docker", "compose", "-f", COMPOSE_FILE] + command,
-            capture_output=True, text=True, check=True
+            capture_output=capture, text=capture, check=True, close_fds=False
         )
-        logging.info(result.stdout)
+        if capture:
+            logging.info(result.stdout)
         return result.stdout
     except subprocess.CalledProcessError as e:
         logging.error(f"Failed to run docker compose command '{' '.join(command)}': {e}")
-        logging.error(e.stdout)
+        if capture:
+            logging.error(e.stdout)
         sys.exit(1)
 
-def manage_containers(action: str, config: dict):
+def _config_hash(config: dict) -> str:
+    # pickle keeps this off the yaml import path and, unlike sorted json, copes with
+    # mixed-type keys (YAML 1.1 loads on/off/yes/no keys as bools); the same config.yml
+    # always loads with the same key order, and the pinned protocol keeps the bytes
+    # stable across Python versions
+    serialized = pickle.dumps(config, protocol=PICKLE_PROTOCOL)
+    return hashlib.blake2b(serialized, digest_size=16).hexdigest()
+
+def _compose_mtime():
+    try:
+        return os.stat(COMPOSE_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _read_state(file_path: str = STATE_FILE):
+    try:
+        with open(file_path, "r") as file:
+            config_hash, compose_mtime = file.read().split()
+        return config_hash, int(compose_mtime)
+    except (OSError, ValueError):
+        return None
+
+def _write_state(config_hash: str, file_path: str = STATE_FILE):
+    try:
+        with open(file_path, "w") as file:
+            file.write(f"{config_hash} {_compose_mtime()}\n")
+    except OSError as e:
+        logging.debug(f"Could not write state file {file_path}: {e}")
+
+def _compose_project_name() -> str:
+    # Mirrors docker compose's default: COMPOSE_PROJECT_NAME, else the compose file's directory name
+    name = os.environ.get("COMPOSE_PROJECT_NAME") or os.path.basename(os.path.dirname(os.path.abspath(COMPOSE_FILE)))
+    return re.sub(r"[^a-z0-9_-]", "", name.lower()).lstrip("_-")
+
+def _containers_running() -> bool:
+    # The docker SDK talks to the daemon socket directly; fall back to the compose CLI without it
+    try:
+        import docker
+    except ImportError:
+        return bool(run_docker_compose_command(["ps", "-q"], capture=True).strip())
+    try:
+        client = docker.from_env()
+        try:
+            label = f"com.docker.compose.project={_compose_project_name()}"
+            return bool(client.containers.list(filters={"label": label}))
+        finally:
+            client.close()
+    except docker.errors.DockerException as e:
+        logging.debug(f"Docker SDK unavailable, falling back to docker compose: {e}")
+        return bool(run_docker_compose_command(["ps", "-q"], capture=True).strip())
+
+def manage_containers(action: str, config: dict, force: bool = False):
 
     if action == "up":
-        running_containers = run_docker_compose_command(["ps", "-q"]).strip()
-        if running_containers:
-            logging.info("Containers already running, restarting them.")
-            run_docker_compose_command(["down", "-v"])
-        # Configs needs to be generated after stopping the containers, and before starting the new ones
-        generate_compose_file(config)
-        generate_haproxy_config(config)
-        run_docker_compose_command(["up", "-d"])
+        config_hash = _config_hash(config)
+        if not force and _read_state() == (config_hash, _compose_mtime()) and _containers_running():
+            logging.info("Configuration unchanged and containers running, already up-to-date")
+            return
+        generate_all(config)
+        # A single up call recreates running containers and drops services removed from the config
+        run_docker_compose_command(["up", "-d", "--force-recreate", "--remove-orphans"])
+        _write_state(config_hash)
         logging.info("Started or restarted VPN containers and HAProxy")
     elif action == "down":
         run_docker_compose_command(["down"])
         logging.info("Stopped VPN containers and HAProxy")
 
 def list_containers():
-    services = run_docker_compose_command(["ps", "--services"]).split()
+    services = run_docker_compose_command(["ps", "--services"], capture=True).split()
     logging.info(f"Services: {', '.join(services)}")
     return services
 
@@ -131,37 +305,38 @@ def start_interactive_shell(config: dict):
     run_docker_compose_command(cmd)
 
 def parse_arguments():
-    parser = argparse.ArgumentParser(description="VPN container orchestration script")
-    parser.add_argument(
-        "action",
-        choices=["up", "down", "list", "run", "interactive"],
-        help="Action to perform"
-    )
-    parser.add_argument(
-        "cmd",
-        nargs="*",
-        help="Command to run through the proxy (only required for 'run' action)"
-    )
-    args = parser.parse_args()
+    # Hand-rolled instead of argparse: the CLI is one action plus an optional command
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+        print(USAGE)
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in ACTIONS:
+        print(USAGE, file=sys.stderr)
+        sys.exit(2)
+    args = SimpleNamespace(action=sys.argv[1], cmd=sys.argv[2:], force=False)
+    if args.action == "up":
+        if args.cmd not in ([], ["--force"]):
+            print(f"{USAGE}\nerror: unrecognized arguments: {' '.join(args.cmd)}", file=sys.stderr)
+            sys.exit(2)
+        args.force = bool(args.cmd)
     if args.action == "run" and not args.cmd:
-        parser.error("The 'run' action requires a command to be specified.")
+        print(f"{USAGE}\nerror: The 'run' action requires a command to be specified.", file=sys.stderr)
+        sys.exit(2)
     return args
 
 def main():
-    config = load_config()
     args = parse_arguments()
-    command_methods = {
-        "up": lambda: manage_containers("up", config),
-        "down": lambda: manage_containers("down", config),
-        "list": list_containers,
-        "run": lambda: run_command_through_proxy(args.cmd, config),
-        "interactive": lambda: start_interactive_shell(config),
-    }
-    if args.action in command_methods:
-        command_methods[args.action]()
-    else:
-        logging.error(f"Unknown command: {args.action}")
-        sys.exit(1)
+    config = load_config() if args.action in CONFIG_ACTIONS else None
+    action = args.action
+    if action == "up":
+        manage_containers("up", config, force=args.force)
+    elif action == "down":
+        manage_containers("down", config)
+    elif action == "list":
+        list_containers()
+    elif action == "run":
+        run_command_through_proxy(args.cmd, config)
+    elif action == "interactive":
+        start_interactive_shell(config)
 
 if __name__ == "__main__":
     main()